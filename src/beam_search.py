@@ -16,39 +16,66 @@
 
 """This file contains code to run beam search decoding"""
 
+import heapq
+from collections import namedtuple
 import tensorflow as tf
 import numpy as np
 import data
 from replay_buffer import Transition, ReplayBuffer
-from collections import Counter
-from sklearn.preprocessing import normalize
 
 FLAGS = tf.app.flags.FLAGS
 
+# Node of a persistent singly linked list. Hypotheses extended from the same parent share its history instead of copying it.
+Node = namedtuple('Node', 'val prev')
+
+def to_chain(values):
+  """Return a Node chain holding values (the last value at the head), or None if values is empty"""
+  node = None
+  for value in values:
+    node = Node(value, node)
+  return node
+
+def from_chain(node):
+  """Return the values held by a Node chain as a list, oldest first"""
+  values = []
+  while node is not None:
+    values.append(node.val)
+    node = node.prev
+  values.reverse()
+  return values
+
 class Hypothesis(object):
   """Class to represent a hypothesis during beam search. Holds all the information needed for the hypothesis."""
 
-  def __init__(self, tokens, log_probs, state, decoder_output, encoder_mask, attn_dists, p_gens, coverage):
+  def __init__(self, tokens, log_probs, state, attn_dists, p_gens, coverage, parent=0, trigrams=None, new_trigram=None, sum_log_prob=None, num_tokens=None):
     """Hypothesis constructor.
 
     Args:
-      tokens: List of integers. The ids of the tokens that form the summary so far.
-      log_probs: List, same length as tokens, of floats, giving the log probabilities of the tokens so far.
+      tokens: Node chain (see to_chain) of integers. The ids of the tokens that form the summary so far.
+      log_probs: Node chain (see to_chain), same length as tokens, of floats, giving the log probabilities of the tokens so far.
       state: Current state of the decoder, a LSTMStateTuple.
-      attn_dists: List, same length as tokens, of numpy arrays with shape (attn_length). These are the attention distributions so far.
-      p_gens: List, same length as tokens, of floats, or None if not using pointer-generator model. The values of the generation probability so far.
+      attn_dists: Node chain of numpy arrays with shape (attn_length). These are the attention distributions so far.
+      p_gens: Node chain of floats, or None if not using pointer-generator model. The values of the generation probability so far.
       coverage: Numpy array of shape (attn_length), or None if not using coverage. The current coverage vector.
+      parent: Integer. Index, in the previous step's beam, of the hypothesis this one was extended from. Used to reorder the per-beam decoder output and temporal attention buffers.
+      trigrams: Frozenset of the token trigrams in tokens (possibly without new_trigram), or None if repeated trigrams are allowed.
+      new_trigram: Tuple, the trailing trigram of tokens if it is not yet merged into trigrams, else None.
+      sum_log_prob: Float. Sum of the log_probs, computed from log_probs if not given.
+      num_tokens: Integer. Length of tokens, computed from tokens if not given.
     """
-    self.tokens = tokens
-    self.log_probs = log_probs
+    self._tokens = tokens
+    self._log_probs = log_probs
     self.state = state
-    self.decoder_output = decoder_output
-    self.encoder_mask = encoder_mask
-    self.attn_dists = attn_dists
-    self.p_gens = p_gens
+    self._attn_dists = attn_dists
+    self._p_gens = p_gens
     self.coverage = coverage
+    self.parent = parent
+    self.trigrams = trigrams
+    self._new_trigram = new_trigram
+    self._sum_log_prob = sum_log_prob if sum_log_prob is not None else sum(from_chain(log_probs))
+    self._len = num_tokens if num_tokens is not None else len(from_chain(tokens))
 
-  def extend(self, token, log_prob, state, decoder_output, encoder_mask, attn_dist, p_gen, coverage):
+  def extend(self, token, log_prob, state, attn_dist, p_gen, coverage, parent):
     """Return a NEW hypothesis, extended with the information from the latest step of beam search.
 
     Args:
@@ -58,41 +85,64 @@ class Hypothesis(object):
       attn_dist: Attention distribution from latest step. Numpy array shape (attn_length).
       p_gen: Generation probability on latest step. Float.
       coverage: Latest coverage vector. Numpy array shape (attn_length), or None if not using coverage.
+      parent: Integer. Index of this hypothesis in the current beam.
     Returns:
       New Hypothesis for next step.
     """
-    if FLAGS.avoid_trigrams and self._has_trigram(self.tokens + [token]):
+    if self._new_trigram is not None:
+      # Only hypotheses that survive pruning get extended, so the trigram set is copied once per survivor
+      # here rather than once per candidate
+      self.trigrams = self.trigrams | {self._new_trigram}
+      self._new_trigram = None
+    new_trigram = None
+    if self.trigrams is not None and self._len >= 2:
+      # Only the trailing trigram is new; every earlier one is already in self.trigrams
+      new_trigram = (self._tokens.prev.val, self._tokens.val, token)
+      if new_trigram in self.trigrams:
         log_prob = -np.infty
-    return Hypothesis(tokens = self.tokens + [token],
-                      log_probs = self.log_probs + [log_prob],
+        new_trigram = None
+    return Hypothesis(tokens = Node(token, self._tokens),
+                      log_probs = Node(log_prob, self._log_probs),
                       state = state,
-                      decoder_output= self.decoder_output + [decoder_output] if decoder_output is not None else [],
-                      encoder_mask = self.encoder_mask + [encoder_mask] if encoder_mask is not None else [],
-                      attn_dists = self.attn_dists + [attn_dist],
-                      p_gens = self.p_gens + [p_gen],
-                      coverage = coverage)
+                      attn_dists = Node(attn_dist, self._attn_dists), # by reference: all extensions of a hypothesis share the same attn_dist row
+                      p_gens = Node(p_gen, self._p_gens),
+                      coverage = coverage,
+                      parent = parent,
+                      trigrams = self.trigrams,
+                      new_trigram = new_trigram,
+                      sum_log_prob = self._sum_log_prob + log_prob,
+                      num_tokens = self._len + 1)
+
+  # The list views below walk the whole chain; they are meant for the final hypothesis, not the beam loop.
+  @property
+  def tokens(self):
+    return from_chain(self._tokens)
 
-  def _find_ngrams(self, input_list, n):
-      return zip(*[input_list[i:] for i in range(n)])
+  @property
+  def log_probs(self):
+    return from_chain(self._log_probs)
 
-  def _has_trigram(self, tokens):
-      tri_grams = self._find_ngrams(tokens, 3)
-      cnt = Counter(tri_grams)
-      return not all((cnt[g] == 1 for g in cnt))
+  @property
+  def attn_dists(self):
+    return from_chain(self._attn_dists)
+
+  @property
+  def p_gens(self):
+    return from_chain(self._p_gens)
 
   @property
   def latest_token(self):
-    return self.tokens[-1]
+    return self._tokens.val
 
   @property
   def log_prob(self):
     # the log probability of the hypothesis so far is the sum of the log probabilities of the tokens so far
-    return sum(self.log_probs)
+    return self._sum_log_prob
 
   @property
   def avg_log_prob(self):
     # normalize log probability by number of tokens (otherwise longer sequences always have lower probability)
-    return self.log_prob / len(self.tokens)
+    return self._sum_log_prob / self._len
 
 
 def run_beam_search(sess, model, vocab, batch, dqn = None, dqn_sess = None, dqn_graph = None):
@@ -108,31 +158,47 @@ def run_beam_search(sess, model, vocab, batch, dqn = None, dqn_sess = None, dqn_
     best_hyp: Hypothesis object; the best hypothesis found by beam search.
   """
 
+  # Read the flags used on every step once; FLAGS attribute access is comparatively slow
+  beam_size = FLAGS.beam_size
+  max_dec_steps = FLAGS.max_dec_steps
+  min_dec_steps = FLAGS.min_dec_steps
+  intradecoder = FLAGS.intradecoder
+  use_temporal_attention = FLAGS.use_temporal_attention
+  ac_training = FLAGS.ac_training
+
   # Run the encoder to get the encoder hidden states and decoder initial state
   enc_states, dec_in_state = model.run_encoder(sess, batch)
   # dec_in_state is a LSTMStateTuple
-  # enc_states has shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+  # enc_states has shape [1, <=max_enc_steps, 2*hidden_dim]; the model tiles it across the beam in-graph.
 
   # Initialize beam_size-many hyptheses
-  hyps = [Hypothesis(tokens=[vocab.word2id(data.START_DECODING)],
-                     log_probs=[0.0],
+  hyps = [Hypothesis(tokens=to_chain([vocab.word2id(data.START_DECODING)]),
+                     log_probs=to_chain([0.0]),
                      state=dec_in_state,
-                     decoder_output = [np.zeros([FLAGS.dec_hidden_dim])],
-                     encoder_mask = [np.zeros([batch.enc_batch.shape[1]])],
-                     attn_dists=[],
-                     p_gens=[],
-                     coverage=np.zeros([batch.enc_batch.shape[1]])  # zero vector of length attention_length
-                     ) for _ in range(FLAGS.beam_size)]
+                     attn_dists=None,
+                     p_gens=None,
+                     coverage=np.zeros([batch.enc_batch.shape[1]]),  # zero vector of length attention_length
+                     trigrams=frozenset() if FLAGS.avoid_trigrams else None
+                     ) for _ in range(beam_size)]
   results = [] # this will contain finished hypotheses (those that have emitted the [STOP] token)
 
+  # The previous decoder outputs and temporal attention scores of every beam are kept in preallocated
+  # (step, beam, dim) buffers instead of per-hypothesis lists. Row 0 is the zero initial value, row t+1 is
+  # written after step t, and the rows are reordered by each hypothesis' parent index whenever the beam is pruned.
+  # The buffers are only allocated when the corresponding attention is turned on.
+  decoder_outputs = np.zeros([max_dec_steps + 1, beam_size, FLAGS.dec_hidden_dim], dtype=np.float32) if intradecoder else None
+  encoder_es = np.zeros([max_dec_steps + 1, beam_size, batch.enc_batch.shape[1]], dtype=np.float32) if use_temporal_attention else None
+
+  stop_id = vocab.word2id(data.STOP_DECODING)
+  unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+  vocab_size = vocab.size()
+
   steps = 0
-  while steps < FLAGS.max_dec_steps and len(results) < FLAGS.beam_size:
+  while steps < max_dec_steps and len(results) < beam_size:
     latest_tokens = [h.latest_token for h in hyps] # latest token produced by each hypothesis
-    latest_tokens = [t if t in range(vocab.size()) else vocab.word2id(data.UNKNOWN_TOKEN) for t in latest_tokens] # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
+    latest_tokens = [t if 0 <= t < vocab_size else unk_id for t in latest_tokens] # change any in-article temporary OOV ids to [UNK] id, so that we can lookup word embeddings
     states = [h.state for h in hyps] # list of current decoder states of the hypotheses
     prev_coverage = [h.coverage for h in hyps] # list of coverage vectors (or None)
-    decoder_outputs = np.array([h.decoder_output for h in hyps]).swapaxes(0, 1) # shape (?, batch_size, dec_hidden_dim)
-    encoder_es = np.array([h.encoder_mask for h in hyps]).swapaxes(0, 1)  # shape (?, batch_size, enc_hidden_dim)
     # Run one step of the decoder to get the new info
     (topk_ids, topk_log_probs, new_states, attn_dists, final_dists, p_gens, new_coverage, decoder_output, encoder_e) = model.decode_onestep(sess=sess,
                         batch=batch,
@@ -140,22 +206,28 @@ def run_beam_search(sess, model, vocab, batch, dqn = None, dqn_sess = None, dqn_
                         enc_states=enc_states,
                         dec_init_states=states,
                         prev_coverage=prev_coverage,
-                        prev_decoder_outputs= decoder_outputs if FLAGS.intradecoder else tf.stack([], axis=0),
-                        prev_encoder_es = encoder_es if FLAGS.use_temporal_attention else tf.stack([], axis=0))
+                        prev_decoder_outputs= decoder_outputs[:steps + 1] if intradecoder else tf.stack([], axis=0), # shape (steps+1, batch_size, dec_hidden_dim)
+                        prev_encoder_es = encoder_es[:steps + 1] if use_temporal_attention else tf.stack([], axis=0)) # shape (steps+1, batch_size, enc_len)
 
-    if FLAGS.ac_training:
+    if ac_training:
       with dqn_graph.as_default():
         dqn_results = dqn.run_test_steps(dqn_sess, x=decoder_output)
         q_estimates = dqn_results['estimates'] # shape (len(transitions), vocab_size)
         # we use the q_estimate of UNK token for all the OOV tokens
-        q_estimates = np.concatenate([q_estimates,np.reshape(q_estimates[:,0],[-1,1])*np.ones((FLAGS.beam_size,batch.max_art_oovs))],axis=-1)
-        # normalized q_estimate
-        q_estimates = normalize(q_estimates, axis=1, norm='l1')
+        oov_estimates = np.broadcast_to(q_estimates[:, :1], (q_estimates.shape[0], batch.max_art_oovs))
+        q_estimates = np.concatenate([q_estimates, oov_estimates], axis=-1)
+        # l1-normalize the q_estimates and their product with the final distribution in place, staying in float32
+        q_estimates /= np.abs(q_estimates).sum(axis=1, keepdims=True) + 1e-12
         combined_estimates = final_dists * q_estimates
-        combined_estimates = normalize(combined_estimates, axis=1, norm='l1')
+        combined_estimates /= np.abs(combined_estimates).sum(axis=1, keepdims=True) + 1e-12
         # overwriting topk ids and probs
-        topk_ids = np.argsort(combined_estimates,axis=-1)[:,-FLAGS.beam_size*2:][:,::-1]
-        topk_probs = [combined_estimates[i,_] for i,_ in enumerate(topk_ids)]
+        # partition out the top 2*beam_size candidates of each row, then only sort those
+        k = beam_size * 2
+        top_k = np.argpartition(-combined_estimates, k - 1, axis=-1)[:, :k]
+        rows = np.arange(combined_estimates.shape[0])[:, None]
+        order = np.argsort(-combined_estimates[rows, top_k], axis=-1)
+        topk_ids = top_k[rows, order]
+        topk_probs = combined_estimates[rows, topk_ids]
         topk_log_probs = np.log(topk_probs)
 
     # Extend each hypothesis and collect them all in all_hyps
@@ -163,37 +235,52 @@ def run_beam_search(sess, model, vocab, batch, dqn = None, dqn_sess = None, dqn_
     num_orig_hyps = 1 if steps == 0 else len(hyps) # On the first step, we only had one original hypothesis (the initial hypothesis). On subsequent steps, all original hypotheses are distinct.
     for i in range(num_orig_hyps):
       h, new_state, attn_dist, p_gen, new_coverage_i = hyps[i], new_states[i], attn_dists[i], p_gens[i], new_coverage[i]  # take the ith hypothesis and new decoder state info
-      decoder_output_i = None
-      encoder_mask_i = None
-      if FLAGS.intradecoder:
-        decoder_output_i = decoder_output[i]
-      if FLAGS.use_temporal_attention:
-        encoder_mask_i = encoder_e[i]
-      for j in range(FLAGS.beam_size * 2):  # for each of the top 2*beam_size hyps:
+      for j in range(beam_size * 2):  # for each of the top 2*beam_size hyps:
         # Extend the ith hypothesis with the jth option
         new_hyp = h.extend(token=topk_ids[i, j],
                            log_prob=topk_log_probs[i, j],
                            state=new_state,
-                           decoder_output = decoder_output_i,
-                           encoder_mask = encoder_mask_i,
                            attn_dist=attn_dist,
                            p_gen=p_gen,
-                           coverage=new_coverage_i)
+                           coverage=new_coverage_i,
+                           parent=i)
         all_hyps.append(new_hyp)
 
     # Filter and collect any hypotheses that have produced the end token.
     hyps = [] # will contain hypotheses for the next step
-    for h in sort_hyps(all_hyps): # in order of most likely h
-      if h.latest_token == vocab.word2id(data.STOP_DECODING): # if stop token is reached...
+    # At most one candidate per original hypothesis is a [STOP], so the 2*beam_size best candidates are enough to fill the beam
+    for h in heapq.nlargest(beam_size * 2, all_hyps, key=lambda h: h.avg_log_prob): # in order of most likely h
+      if h.latest_token == stop_id: # if stop token is reached...
         # If this hypothesis is sufficiently long, put in results. Otherwise discard.
-        if steps >= FLAGS.min_dec_steps:
+        if steps >= min_dec_steps:
           results.append(h)
       else: # hasn't reached stop token, so continue to extend this hypothesis
         hyps.append(h)
-      if len(hyps) == FLAGS.beam_size or len(results) == FLAGS.beam_size:
+      if len(hyps) == beam_size or len(results) == beam_size:
         # Once we've collected beam_size-many hypotheses for the next step, or beam_size-many complete hypotheses, stop.
         break
 
+    # Stop early once no live hypothesis can overtake the best finished one. Log probs are never positive, so a
+    # live hypothesis' average log prob is at most its current sum spread over the longest possible summary.
+    if results and hyps:
+      best_live = max(h.log_prob for h in hyps) / (max_dec_steps + 1)
+      best_done = max(h.avg_log_prob for h in results)
+      if best_live <= best_done:
+        break
+
+    # Append this step's outputs and gather the history of each surviving hypothesis from its parent beam
+    # Only the beam slots whose hypothesis was extended from a different slot need to be copied.
+    moved = [k for k, h in enumerate(hyps) if h.parent != k]
+    sources = [hyps[k].parent for k in moved]
+    if intradecoder:
+      decoder_outputs[steps + 1] = decoder_output
+      if moved:
+        decoder_outputs[:steps + 2, moved] = decoder_outputs[:steps + 2, sources]
+    if use_temporal_attention:
+      encoder_es[steps + 1] = encoder_e
+      if moved:
+        encoder_es[:steps + 2, moved] = encoder_es[:steps + 2, sources]
+
     steps += 1
 
   # At this point, either we've got beam_size results, or we've reached maximum decoder steps
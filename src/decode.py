@@ -204,7 +204,7 @@ class BeamSearchDecoder(object):
         'article_lst': [make_html_safe(t) for t in article_lst],
         'decoded_lst': [make_html_safe(t) for t in decoded_lst],
         'abstract_str': make_html_safe(abstract),
-        'attn_dists': attn_dists
+        'attn_dists': [a.tolist() for a in attn_dists]
     }
     if FLAGS.pointer_gen:
       to_write['p_gens'] = p_gens
@@ -276,6 +276,10 @@ class SummarizationModel(object):
 
       # Add the encoder.
       enc_outputs, fw_st, bw_st = self._add_encoder(emb_enc_inputs, self._enc_lens)
+      if hps.mode == "decode":
+        # In decode mode the batch is a single example repeated, so beam search only fetches and feeds back the first row of encoder states and the graph tiles it across the beam.
+        self._enc_states_single = enc_outputs[:1]
+        enc_outputs = tf.tile(self._enc_states_single, [hps.batch_size, 1, 1])
       self._enc_states = enc_outputs
 
       # Our encoder is bidirectional and our decoder is unidirectional so we need to reduce the final encoder hidden state to the right size to be the initial decoder hidden state
@@ -788,11 +792,11 @@ class SummarizationModel(object):
       batch: Batch object that is the same example repeated across the batch (for beam search)
 
     Returns:
-      enc_states: The encoder states. A tensor of shape [batch_size, <=max_enc_steps, 2*hidden_dim].
+      enc_states: The encoder states of the first example. A tensor of shape [1, <=max_enc_steps, 2*hidden_dim].
       dec_in_state: A LSTMStateTuple of shape ([1,hidden_dim],[1,hidden_dim])
     """
     feed_dict = self._make_feed_dict(batch, just_enc=True) # feed the batch into the placeholders
-    (enc_states, dec_in_state, global_step) = sess.run([self._enc_states, self._dec_in_state, self.global_step], feed_dict) # run the encoder
+    (enc_states, dec_in_state, global_step) = sess.run([self._enc_states_single, self._dec_in_state, self.global_step], feed_dict) # run the encoder
 
     # dec_in_state is LSTMStateTuple shape ([batch_size,hidden_dim],[batch_size,hidden_dim])
     # Given that the batch is a single example repeated, dec_in_state is identical across the batch so we just take the top row.
@@ -806,7 +810,7 @@ class SummarizationModel(object):
       sess: Tensorflow session.
       batch: Batch object containing single example repeated across the batch
       latest_tokens: Tokens to be fed as input into the decoder for this timestep
-      enc_states: The encoder states.
+      enc_states: The encoder states of a single example, shape [1, <=max_enc_steps, 2*hidden_dim]. Tiled across the beam inside the graph.
       dec_init_states: List of beam_size LSTMStateTuples; the decoder states from the previous timestep
       prev_coverage: List of np arrays. The coverage vectors from the previous timestep. List of None if not using coverage.
 
@@ -815,7 +819,7 @@ class SummarizationModel(object):
       probs: top 2k log probabilities. shape [beam_size, 2*beam_size]
       new_states: new states of the decoder. a list length beam_size containing
         LSTMStateTuples each of shape ([hidden_dim,],[hidden_dim,])
-      attn_dists: List length beam_size containing lists length attn_length.
+      attn_dists: List length beam_size containing arrays shape (attn_length).
       p_gens: Generation probabilities for this step. A list length beam_size. List of None if in baseline mode.
       new_coverage: Coverage vectors for this step. A list of arrays. List of None if coverage is not turned on.
     """
@@ -830,7 +834,7 @@ class SummarizationModel(object):
     new_dec_in_state = tf.contrib.rnn.LSTMStateTuple(new_c, new_h)
 
     feed = {
-        self._enc_states: enc_states,
+        self._enc_states_single: enc_states,
         self._enc_padding_mask: batch.enc_padding_mask,
         self._dec_in_state: new_dec_in_state,
         self._dec_batch: np.transpose(np.array([latest_tokens])),
@@ -869,8 +873,8 @@ class SummarizationModel(object):
 
     # Convert singleton list containing a tensor to a list of k arrays
     assert len(results['attn_dists'])==1
-    attn_dists = results['attn_dists'][0].tolist()
-    final_dists = results['final_dists'][0].tolist()
+    attn_dists = list(results['attn_dists'][0]) # row views of the fetched array; beam search shares each row between all extensions of a hypothesis
+    final_dists = results['final_dists'][0] # kept as an array; only the actor-critic branch of beam search reads it
 
     if FLAGS.pointer_gen:
       # Convert singleton list containing a tensor to a list of k arrays
@@ -1,30 +1,49 @@
 from argparse import ArgumentParser
 from pathlib import Path
-import glob
 import os
 from shutil import copy2
 
 
+def _iter_txt_files(root):
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_file() and entry.name.endswith('.txt'):
+                yield entry.path
+
+
+def _link_or_copy(src, dst):
+    # Hardlink instead of copying the summary. An existing dst may itself be a link to a source summary
+    # from an earlier run, so it is removed rather than written through.
+    try:
+        os.unlink(dst)
+    except FileNotFoundError:
+        pass
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Fall back to a copy across devices or on filesystems without hardlinks; dst no longer exists here
+        copy2(src, dst)
+
+
 def prepare(experiment):
     # Create new directory for files
     output_dir = os.path.join(os.path.dirname(experiment), "rouge_" + os.path.basename(experiment))
-    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    output_decoded = os.path.join(output_dir, 'decoded')
+    output_reference = os.path.join(output_dir, 'reference')
+    Path(output_decoded).mkdir(parents=True, exist_ok=True)
+    Path(output_reference).mkdir(parents=True, exist_ok=True)
 
     # Move files into new directory
     ids = {}
-    for inx, file in enumerate(glob.iglob(os.path.join(experiment, 'decoded/*.txt'), recursive=True)):
+    for inx, file in enumerate(_iter_txt_files(os.path.join(experiment, 'decoded'))):
         identifier = os.path.basename(file).split("_")[0]
         ids[identifier] = inx
-        dirname = os.path.dirname(file.replace(experiment, output_dir))
-        Path(dirname).mkdir(parents=True, exist_ok=True)
-        copy2(file, os.path.join(dirname, "%06d_decoded.txt" % inx))
+        _link_or_copy(file, os.path.join(output_decoded, "%06d_decoded.txt" % inx))
 
-    for file in glob.iglob(os.path.join(experiment, 'reference/*.txt'), recursive=True):
+    for file in _iter_txt_files(os.path.join(experiment, 'reference')):
         identifier = os.path.basename(file).split("_")[0]
         inx = ids[identifier]
-        dirname = os.path.dirname(file.replace(experiment, output_dir))
-        Path(dirname).mkdir(parents=True, exist_ok=True)
-        copy2(file, os.path.join(dirname, "%06d_reference.txt" % inx))
+        _link_or_copy(file, os.path.join(output_reference, "%06d_reference.txt" % inx))
 
 
 if __name__ == '__main__':
@@ -32,4 +51,3 @@ if __name__ == '__main__':
     parser.add_argument("-p", "--path", required=True, dest="path")
     args = parser.parse_args()
     prepare(args.path)
-
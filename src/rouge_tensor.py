@@ -23,20 +23,31 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+import functools
+import os
 import re
+import typing
+from concurrent.futures import ThreadPoolExecutor
 
 import nltk
+try:
+  import numba
+except ImportError:
+  numba = None
 import numpy as np
-import data
-import tensorflow as tf
 
-from modeling.score import FactCC
+# tensorflow and data (which pulls in tensorflow) are imported inside the functions that build
+# TF ops, so the pure-Python scoring helpers can be used without paying for the TF import.
+if typing.TYPE_CHECKING:
+  from modeling.score import FactCC
 
 
 def _len_lcs(x, y):
   """Returns the length of the Longest Common Subsequence between two seqs.
 
-  Source: http://www.algorithmist.com/index.php/Longest_Common_Subsequence
+  Tokens shared by the start or the end of both sequences are always part of
+  an LCS, so they are counted directly and only the remaining middle parts
+  are handed to the LCS kernel.
 
   Args:
     x: sequence of words
@@ -45,36 +56,79 @@ def _len_lcs(x, y):
   Returns
     integer: Length of LCS between x and y
   """
-  table = _lcs(x, y)
   n, m = len(x), len(y)
-  return table[n, m]
-
-
-def _lcs(x, y):
+  start = 0
+  while start < n and start < m and x[start] == y[start]:
+    start += 1
+  end = 0
+  while end < n - start and end < m - start and x[n - 1 - end] == y[m - 1 - end]:
+    end += 1
+  if start + end == n or start + end == m:
+    return start + end
+  return start + end + _len_lcs_middle(x[start:n - end], y[start:m - end])
+
+
+def _len_lcs_dp(x, y):
   """Computes the length of the LCS between two seqs.
 
   The implementation below uses a DP programming algorithm and runs
-  in O(nm) time where n = len(x) and m = len(y).
+  in O(nm) time where n = len(x) and m = len(y). Only the previous and the
+  current row of the DP table are kept, so memory is O(m).
   Source: http://www.algorithmist.com/index.php/Longest_Common_Subsequence
 
   Args:
-    x: collection of words
-    y: collection of words
+    x: array of word ids
+    y: array of word ids
 
   Returns:
-    Table of dictionary of coord and len lcs
+    integer: Length of LCS between x and y
   """
   n, m = len(x), len(y)
-  table = dict()
-  for i in range(n + 1):
-    for j in range(m + 1):
-      if i == 0 or j == 0:
-        table[i, j] = 0
-      elif x[i - 1] == y[j - 1]:
-        table[i, j] = table[i - 1, j - 1] + 1
+  prev = np.zeros(m + 1, np.int16)
+  cur = np.zeros(m + 1, np.int16)
+  for i in range(1, n + 1):
+    for j in range(1, m + 1):
+      if x[i - 1] == y[j - 1]:
+        cur[j] = prev[j - 1] + 1
       else:
-        table[i, j] = max(table[i - 1, j], table[i, j - 1])
-  return table
+        cur[j] = max(prev[j], cur[j - 1])
+    prev, cur = cur, prev
+  return int(prev[m])
+
+
+def _len_lcs_bits(x, y):
+  """Computes the length of the LCS between two seqs with a bit-parallel algorithm.
+
+  Bit i of a row vector stands for position i of x, so a whole row of the
+  DP table is updated with a few integer operations per word of y
+  (Allison and Dix, 1986). Python integers have arbitrary precision, so
+  this runs in O(nm/w) word operations for any n.
+
+  Args:
+    x: array of word ids
+    y: array of word ids
+
+  Returns:
+    integer: Length of LCS between x and y
+  """
+  x, y = list(x), list(y)
+  matches = {}
+  for i, word in enumerate(x):
+    matches[word] = matches.get(word, 0) | (1 << i)
+  full = (1 << len(x)) - 1
+  row = full
+  for word in y:
+    u = row & matches.get(word, 0)
+    row = ((row + u) | (row - u)) & full
+  # every cleared bit is a matched position of x
+  return len(x) - bin(row).count('1')
+
+
+if numba is not None:
+  # nogil lets the LCS of different examples run concurrently on _POOL
+  _len_lcs_middle = numba.njit(cache=True, nogil=True)(_len_lcs_dp)
+else:
+  _len_lcs_middle = _len_lcs_bits
 
 
 def _f_lcs(llcs, m, n):
@@ -100,7 +154,36 @@ def _f_lcs(llcs, m, n):
   return f_lcs
 
 
-def rouge_l_sentence_level(vocab, scorer: FactCC):
+def _f_lcs_pair(pair):
+  """Computes the LCS-based F-measure of an (eval_sentence, ref_sentence) pair of token id sequences."""
+  eval_sentence, ref_sentence = pair
+  lcs = _len_lcs(np.asarray(eval_sentence, dtype=np.int32), np.asarray(ref_sentence, dtype=np.int32))
+  return _f_lcs(lcs, len(ref_sentence), len(eval_sentence))
+
+
+# Replacements applied by untokenize before and after the punctuation regexes, in order
+_UNTOKENIZE_PRE = (("`` ", '"'), (" ''", '"'), ('. . .', '...'), (" ( ", " ("), (" ) ", ") "))
+_UNTOKENIZE_PUNCT = re.compile(r' ([.,:;?!%]+)([ \'"`])')
+_UNTOKENIZE_PUNCT_END = re.compile(r' ([.,:;?!%]+)$')
+_UNTOKENIZE_POST = ((" '", "'"), (" n't", "n't"), ("can not", "cannot"), (" ` ", " '"))
+
+
+@functools.lru_cache(maxsize=4096)
+def _sent_tokenize(text):
+  """Splits text into a tuple of sentences with nltk.sent_tokenize.
+
+  Results are cached since the same story is repeated across the batch
+  during beam search.
+  """
+  return tuple(nltk.sent_tokenize(text))
+
+
+# Examples in a batch are independent, so their ROUGE-L scores are computed in parallel when the
+# LCS kernel releases the GIL. The pure-Python kernel would only serialize on the pool.
+_POOL = ThreadPoolExecutor(max_workers=os.cpu_count()) if numba is not None else None
+
+
+def rouge_l_sentence_level(vocab, scorer: 'FactCC'):
   """Computes ROUGE-L (sentence level) of two collections of sentences.
 
   Source: https://www.microsoft.com/en-us/research/publication/
@@ -124,6 +207,7 @@ def rouge_l_sentence_level(vocab, scorer: FactCC):
   Returns:
     A float: F_lcs
   """
+  import data
 
   def untokenize(sentence):
     """
@@ -132,14 +216,13 @@ def rouge_l_sentence_level(vocab, scorer: FactCC):
     Ideally, `untokenize(tokenize(text))` should be identical to `text`,
     except for line breaks.
     """
-    step1 = sentence.replace("`` ", '"').replace(" ''", '"').replace('. . .', '...')
-    step2 = step1.replace(" ( ", " (").replace(" ) ", ") ")
-    step3 = re.sub(r' ([.,:;?!%]+)([ \'"`])', r"\1\2", step2)
-    step4 = re.sub(r' ([.,:;?!%]+)$', r"\1", step3)
-    step5 = step4.replace(" '", "'").replace(" n't", "n't").replace(
-      "can not", "cannot")
-    step6 = step5.replace(" ` ", " '")
-    return step6.strip()
+    for old, new in _UNTOKENIZE_PRE:
+      sentence = sentence.replace(old, new)
+    sentence = _UNTOKENIZE_PUNCT.sub(r"\1\2", sentence)
+    sentence = _UNTOKENIZE_PUNCT_END.sub(r"\1", sentence)
+    for old, new in _UNTOKENIZE_POST:
+      sentence = sentence.replace(old, new)
+    return sentence.strip()
 
   def func(eval_sentences, ref_sentences, story_sentences, stories, abstracts, art_oovs):
     # tf.logging.info('eval: ' + str(len(eval_sentences)))
@@ -195,15 +278,13 @@ def rouge_l_sentence_level(vocab, scorer: FactCC):
     #   ref_sents.append(untokenize(sent))
     # tf.logging.info('ref_sentences: ' + str(ref_sents[0]))
 
-    factcc_scores = scorer.score([nltk.sent_tokenize(s) for s in story_sents], [nltk.sent_tokenize(s) for s in eval_sents])
+    factcc_scores = scorer.score([list(_sent_tokenize(s)) for s in story_sents], [list(_sent_tokenize(s)) for s in eval_sents])
     # factcc_scores_ref = scorer.score([nltk.sent_tokenize(s) for s in story_sents], [nltk.sent_tokenize(s) for s in ref_sents])
 
-    f1_scores = []
-    for eval_sentence, ref_sentence in zip(eval_sentences, ref_sentences):
-      m = len(ref_sentence)
-      n = len(eval_sentence)
-      lcs = _len_lcs(eval_sentence, ref_sentence)
-      f1_scores.append(_f_lcs(lcs, m, n))
+    if _POOL is not None:
+      f1_scores = list(_POOL.map(_f_lcs_pair, zip(eval_sentences, ref_sentences)))
+    else:
+      f1_scores = [_f_lcs_pair(pair) for pair in zip(eval_sentences, ref_sentences)]
 
     # print(f1_scores)
     # print(list(
@@ -230,6 +311,7 @@ def rouge_l_fscore(hypothesis, references, **unused_kwargs):
   Returns:
     rouge_l_fscore: approx rouge-l f1 score.
   """
+  import tensorflow as tf
   rouge_l_f_score = tf.py_func(rouge_l_sentence_level(unused_kwargs['vocab'], unused_kwargs["scorer"]), (hypothesis, references, unused_kwargs['enc_batch'], unused_kwargs['stories'], unused_kwargs['abstracts'], unused_kwargs['art_oovs']), [tf.float32])
 
   return rouge_l_f_score
@@ -309,6 +391,7 @@ def rouge_2_fscore(predictions, labels, **unused_kwargs):
   Returns:
     rouge2_fscore: approx rouge-2 f1 score.
   """
+  import tensorflow as tf
 
   rouge_2_f_score = tf.py_func(rouge_n, (predictions, labels), [tf.float32])
   return rouge_2_f_score, tf.constant(1.0)